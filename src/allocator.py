@@ -1,7 +1,8 @@
+from collections import Counter, defaultdict, deque
 from functools import wraps
 
 from mpi4py import MPI
-from mpi_process import MPI_process
+from mpi_process import MPI_process, Retry
 import traceback
 
 
@@ -21,7 +22,12 @@ def public_handler(handler):
 
     @wraps(handler)
     def wrapper(*args, **kwargs):
+        # the message is forwarded with the public handler until it reaches the owner of the vid
+        args[1]['data']['handler'] = handler.__name__
         if 'master' not in args[1]['data']:
+            if args[0].saturated():  # new request from an application
+                args[0]._send(Retry(args[1]['data']), args[1]['src'], args[1]['data'].get('response_tag', 10))
+                return
             args[1]['data']['master'] = args[1]['dst']
             args[1]['data']['caller'] = args[1]['src']
         return handler(*args, **kwargs)
@@ -37,30 +43,101 @@ class Allocator(MPI_process):
     Allocator class. Inherits from MPI_process.
     Creates the variable dictionnary, and implements the run function
     which contains the only _receive call.
+    Counts the messages received and forwarded by the process for the stats handler.
+    Requests to a peer without credits are kept in a backlog instead of blocking,
+    and new requests from the applications get a Retry response once saturated,
+    that is when saturation requests are queued or waiting for credits (4 windows by default).
     '''
-    def __init__(self, rank, comm, size, verbose=False):
+    def __init__(self, rank, comm, size, verbose=False, window=16, saturation=None):
         global instantiation_id
-        super(Allocator, self).__init__(rank, comm, verbose, f'Allocator{instantiation_id}')
+        super(Allocator, self).__init__(rank, comm, verbose, f'Allocator{instantiation_id}', window=window)
         instantiation_id += 1
         self.variables = {}
         self.local_size = size
         self.stop = False
+        self.queue = deque()
+        self.received = Counter()  # handler name -> number of messages
+        self.forwarded = Counter()  # handler name -> number of messages
+        self.peers = Counter()  # rank -> number of messages exchanged
+        self.bytes_received = 0
+        self.max_queue_depth = 0
+        self.backlog = defaultdict(deque)  # rank -> requests waiting for credits
+        self.saturation = 4 * window if saturation is None else saturation
+
+    def _send(self, data, dest, tag):
+        if tag == 1 and (self.backlog[dest] or not self._has_credit(dest)):
+            self.backlog[dest].append(data)
+            return
+        self._post(data, dest, tag)
+
+    def _post(self, data, dest, tag):
+        if tag == 2:
+            handler_name = 'credit'
+        else:
+            handler_name = data['handler'] if type(data) == dict and 'handler' in data else 'response'
+        self.forwarded[handler_name] += 1
+        self.peers[dest] += 1
+        super(Allocator, self)._send(data, dest, tag)
+
+    def _flush_backlog(self, dest):
+        while self.backlog[dest] and self._has_credit(dest):
+            self._post(self.backlog[dest].popleft(), dest, 1)
+
+    def saturated(self):
+        backlog_size = sum(len(backlog) for backlog in self.backlog.values())
+        return self.window and len(self.queue) + backlog_size >= self.saturation
+
+    def _fill_queue(self):
+        '''
+        Receive every pending request and credit, blocking only if there is no request.
+        '''
+        status = MPI.Status()
+        while not self.queue or self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status):
+            if not self.queue:
+                self.comm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            src = status.Get_source()
+            tag = status.Get_tag()
+            message = self._receive(src, tag, status)
+            self.bytes_received += status.Get_count()
+            self.peers[src] += 1
+            if tag == 2:
+                self._flush_backlog(src)
+            else:
+                self.queue.append(message)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+
+    def periodic(self):
+        '''
+        Called between two requests, does nothing by default.
+        '''
+        pass
 
     def run(self):
         while not self.stop:
             try:
-                request = self._receive(MPI.ANY_SOURCE, 1)
+                self._fill_queue()
+                request = self.queue.popleft()
                 handler_name = request['data']['handler']
+                self.received[handler_name] += 1
                 self.log(f'Call handler "{handler_name}"')
                 if handler_name not in translation_table:
                     raise RuntimeError(f'No available handler for this id {handler_name}')
                 handlers[translation_table[handler_name]](self, request)
+                self._consume(request)
+                self.periodic()
 
             except Exception as e:
                 self.log(f'exception: {traceback.format_exc()}\nOn allocator: {self}')
                 self.stop = True
                 self.comm.Abort(1)
 
+        # the last requests, such as the stop of the children, may still wait for credits
+        status = MPI.Status()
+        while any(self.backlog.values()):
+            self.comm.Probe(source=MPI.ANY_SOURCE, tag=2, status=status)
+            self._receive(status.Get_source(), 2)
+            self._flush_backlog(status.Get_source())
+
     def __repr__(self):
         r = f'{self.__class__.__module__}.{self.__class__.__name__} at {hex(id(self))}'
         return f'{r} variables={self.variables}, local size={self.local_size}, stop={self.stop}'
@@ -1,35 +1,115 @@
-from mpi_process import MPI_process
+from collections import OrderedDict
+import time
+
+from mpi_process import MPI_process, Retry
 
 
 class Application(MPI_process):
-    def __init__(self, rank, allocator_rank, comm, verbose, app_com=None, log=False):
-        super(Application, self).__init__(rank, comm, verbose, self.__class__.__name__, savelog=log)
+    '''
+    Client side of the distributed allocator.
+    Array reads can be served from a bounded local buffer filled by
+    asynchronous prefetch requests. Sequential or strided scans of a vid
+    trigger read-ahead when readahead is set to the number of indices
+    to fetch in advance, refilled by blocks once half of them are read.
+    A prefetched value is served to at most one read, and the buffer is emptied
+    on barrier and free: a read from the buffer may miss the writes of the other
+    applications since the prefetch was sent, but not the ones before it.
+    Sending a request blocks while the allocator has not handled the previous window
+    of requests, and requests rejected by a saturated allocator are sent again later.
+    When write_buffer is set, array writes are kept locally and sent in batches
+    on flush, when write_buffer writes are pending, or on barrier. They get their
+    clocks when sent, so a buffered write is ordered as a write sent at flush time.
+    The pending writes of a range are flushed before it is prefetched.
+    '''
+    # Configuration overriding the command line, used by the test applications
+    options = {}
+    allocator_options = {}
+
+    def __init__(self, rank, allocator_rank, comm, verbose, app_com=None, log=False,
+                 readahead=0, readahead_buffer=256, window=16, write_buffer=0):
+        super(Application, self).__init__(rank, comm, verbose, self.__class__.__name__, savelog=log, window=window)
         self.allocator_rank = allocator_rank
         if app_com:
             self.app_com = app_com
+        self.readahead = readahead
+        self.readahead_buffer = readahead_buffer
+        self.prefetched = OrderedDict()  # (vid, index) -> value
+        self.pending_prefetch = {}  # (vid, start) -> (stop, step)
+        self.access_pattern = {}  # vid -> (last index, stride)
+        self.readahead_mark = {}  # vid -> furthest index requested by read-ahead
+        self.array_end = {}  # vid -> size of the array, once a prefetch reached its end
+        self.write_buffer = write_buffer
+        self.pending_writes = OrderedDict()  # (vid, index) -> value
+        self.retries = 0  # requests rejected by a saturated allocator
 
     def read(self, vid, index=None):
+        if (vid, index) in self.pending_writes:
+            return self.pending_writes[(vid, index)]
+        if index is not None:
+            self._track_access(vid, index)
+            if self._wait_covered(vid, index):
+                return self.prefetched.pop((vid, index))
         data = {
             'handler': 'read_variable',
             'vid': vid,
         }
         if index is not None:
             data['index'] = index
-        self._send(data, self.allocator_rank, 1)
-        return self._receive(self.allocator_rank, 10)['data']
+        return self._request(data)
+
+    def prefetch(self, vid, start, stop, step=1):
+        '''
+        Asynchronously fetch the indices range(start, stop, step) of an array
+        into the local buffer. The range is truncated to the size of the buffer.
+        '''
+        start = max(start, 0)
+        stop = min(stop, start + self.readahead_buffer * step)
+        while start < stop and self._covered(vid, start):
+            start += step
+        last = start + (stop - 1 - start) // step * step
+        while last >= start and self._covered(vid, last):
+            last -= step
+        stop = last + 1
+        if start >= stop:
+            return
+        if any(key[0] == vid and key[1] in range(start, stop, step) for key in self.pending_writes):
+            self.flush(vid)
+        self._send({
+                'handler': 'read_chunk',
+                'vid': vid,
+                'index': start,
+                'stop': stop,
+                'step': step,
+                'key': (vid, start),
+                'response_tag': 11,
+            }, self.allocator_rank, 1)
+        self.pending_prefetch[(vid, start)] = (stop, step)
 
     def allocate(self, size=1):
-        self._send({'handler': 'dmalloc', 'size': size}, self.allocator_rank, 1)
-        return self._receive(self.allocator_rank, 10)['data']
+        return self._request({'handler': 'dmalloc', 'size': size})
 
     def free(self, vid):
-        self._send({
+        self._drop_prefetched(vid)
+        for key in [key for key in self.pending_writes if key[0] == vid]:
+            del self.pending_writes[key]
+        return self._request({
                 'handler': 'dfree',
                 'vid': vid,
-            }, self.allocator_rank, 1)
-        return self._receive(self.allocator_rank, 10)['data']
+            })
 
     def write(self, vid, value, index=None):
+        if index is not None:
+            if self.write_buffer:
+                # read from the buffer until flushed, then from the allocator
+                self.prefetched.pop((vid, index), None)
+                self.pending_writes.pop((vid, index), None)
+                self.pending_writes[(vid, index)] = value
+                if len(self.pending_writes) >= self.write_buffer:
+                    self.flush()
+                return True
+            # A pending chunk would overwrite the written value with a stale one
+            if self._wait_covered(vid, index):
+                self.prefetched[(vid, index)] = value
         data = {
                 'handler': 'dwrite',
                 'vid': vid,
@@ -37,5 +117,194 @@ class Application(MPI_process):
         }
         if index is not None:
             data['index'] = index
-        self._send(data, self.allocator_rank, 1)
-        return self._receive(self.allocator_rank, 10)['data']
+        return self._request(data)
+
+    def stats(self):
+        '''
+        Returns a cluster-wide snapshot of the allocators counters.
+        '''
+        return self._request({'handler': 'stats'})
+
+    def dreduce(self, vid, operator, function=None, args=()):
+        '''
+        Reduces an array with a registered operator, optionally applying
+        a registered function to each value first. Unwritten values are skipped.
+        '''
+        return self._collective({
+                'handler': 'dreduce',
+                'vid': vid,
+                'operator': operator,
+                'function': function,
+                'args': args,
+            })
+
+    def dscan(self, vid, operator):
+        '''
+        Inclusive prefix scan of an array in place, returns the total.
+        '''
+        return self._collective({'handler': 'dscan', 'vid': vid, 'operator': operator})
+
+    def dmap(self, vid, function, args=()):
+        '''
+        Applies a registered function to each value of an array in place,
+        returns the number of values updated.
+        '''
+        return self._collective({'handler': 'dmap', 'vid': vid, 'function': function, 'args': args})
+
+    def histogram(self, vid, width):
+        '''
+        Counts the values of an array by buckets of width, returns a dictionary
+        bucket -> number of values, with bucket = value // width.
+        '''
+        return dict(self.dreduce(vid, 'add', 'bucket', (width,)) or {})
+
+    def flush(self, vid=None):
+        '''
+        Sends the pending writes, of every variable or only of vid,
+        in one batch per variable. The writes get their clocks in the order
+        they were made. Returns the number of writes applied by the allocators.
+        '''
+        keys = [key for key in self.pending_writes if vid is None or key[0] == vid]
+        # the chunks sent before the writes are skipped only while the writes are pending
+        while any(self._pending_chunk(*key) is not None for key in keys):
+            self._receive_prefetch()
+        batches = {}
+        for key in keys:
+            batches.setdefault(key[0], []).append((key[1], self.pending_writes.pop(key), self.clock))
+            self.clock += 1
+        for batch_vid, writes in batches.items():
+            self._send({'handler': 'dwrite_batch', 'vid': batch_vid, 'writes': writes}, self.allocator_rank, 1)
+        applied = 0
+        retried = []
+        for _ in batches:
+            response = self._receive(self.allocator_rank, 10)['data']
+            if type(response) == Retry:
+                self.retries += 1
+                retried.append(response.request)
+            else:
+                applied += response or 0
+        for request in retried:
+            applied += self._request(request) or 0
+        return applied
+
+    def _collective(self, data):
+        self.flush()
+        self._drop_prefetched(data['vid'])
+        return self._request(data)
+
+    def barrier(self):
+        '''
+        Flush the pending writes and wait for the pending prefetch requests,
+        then synchronize the applications.
+        '''
+        self.flush()
+        while self.pending_prefetch:
+            self._receive_prefetch()
+        self.prefetched.clear()
+        self.readahead_mark.clear()
+        self._receive_credits(self.allocator_rank)
+        self.app_com.barrier()
+
+    def _send(self, data, dest, tag):
+        if tag == 1:
+            self._receive_credits(dest)
+            while not self._has_credit(dest):
+                self._receive(dest, 2)
+        super(Application, self)._send(data, dest, tag)
+
+    def _request(self, data):
+        '''
+        Sends a request to the allocator and waits for the response,
+        backing off while the allocator is saturated.
+        '''
+        delay = 0.001
+        while True:
+            self._send(data, self.allocator_rank, 1)
+            response = self._receive(self.allocator_rank, 10)['data']
+            if type(response) != Retry:
+                return response
+            self.retries += 1
+            self.log(f'Allocator saturated, retry in {delay}s')
+            time.sleep(delay)
+            delay = min(2 * delay, 0.1)
+
+    def _track_access(self, vid, index):
+        '''
+        Detect sequential or strided accesses on a vid, and read ahead the next
+        readahead indices once the same stride is seen twice in a row and less
+        than half of the indices requested by read-ahead are left to read.
+        '''
+        last, stride = self.access_pattern.get(vid, (None, None))
+        new_stride = None if last is None else index - last
+        self.access_pattern[vid] = (index, new_stride)
+        if not self.readahead or not new_stride or new_stride != stride:
+            return
+        mark = self.readahead_mark.get(vid)
+        if mark is None or (mark - index) * new_stride < 0:  # new scan, or behind the current index
+            mark = index
+        if (mark - index) // new_stride > self.readahead // 2:
+            return
+        step = abs(new_stride)
+        first = mark + new_stride
+        last = mark + new_stride * self.readahead
+        low, high = min(first, last), max(first, last)
+        if low < 0:  # first index of the scan in the array
+            low %= step
+        if vid in self.array_end:
+            high = min(high, self.array_end[vid] - 1)
+        mark = high if new_stride > 0 else low
+        self.readahead_mark[vid] = mark
+        if low <= high and (mark - index) * new_stride > 0:
+            # only the indices of the scan are fetched
+            self.prefetch(vid, low, high + 1, step)
+
+    def _covered(self, vid, index):
+        if (vid, index) in self.prefetched:
+            return True
+        return self._pending_chunk(vid, index) is not None
+
+    def _pending_chunk(self, vid, index):
+        for (pending_vid, start), (stop, step) in self.pending_prefetch.items():
+            if pending_vid == vid and index in range(start, stop, step):
+                return pending_vid, start
+        return None
+
+    def _wait_covered(self, vid, index):
+        '''
+        Wait for the prefetch request covering an index, if any.
+        Returns whether the value is in the local buffer.
+        '''
+        while self.pending_prefetch and self.comm.Iprobe(source=self.allocator_rank, tag=11):
+            self._receive_prefetch()
+        while self._pending_chunk(vid, index) is not None:
+            self._receive_prefetch()
+        return (vid, index) in self.prefetched
+
+    def _receive_prefetch(self):
+        chunk = self._receive(self.allocator_rank, 11)['data']
+        if type(chunk) == Retry:  # the values will be read without prefetch
+            self.retries += 1
+            self.pending_prefetch.pop(chunk.request['key'])
+            return
+        vid, start = chunk['key']
+        stop, step = self.pending_prefetch.pop(chunk['key'])
+        end = start + len(chunk['values']) * step
+        if end < stop:  # no index from end in the array
+            self.array_end[vid] = end
+        for i, value in enumerate(chunk['values']):
+            index = start + i * step
+            if (vid, index) in self.pending_writes:  # the buffered value is newer
+                continue
+            self.prefetched[(vid, index)] = value
+            self.prefetched.move_to_end((vid, index))
+        while len(self.prefetched) > self.readahead_buffer:
+            self.prefetched.popitem(last=False)
+
+    def _drop_prefetched(self, vid):
+        while any(pending_vid == vid for pending_vid, _ in self.pending_prefetch):
+            self._receive_prefetch()
+        for key in [key for key in self.prefetched if key[0] == vid]:
+            del self.prefetched[key]
+        self.access_pattern.pop(vid, None)
+        self.readahead_mark.pop(vid, None)
+        self.array_end.pop(vid, None)
@@ -0,0 +1,76 @@
+from collections import Counter
+from functools import reduce
+
+
+operators = {}
+functions = {}
+
+
+def register_operator(operator):
+    '''
+    Registers a binary operator usable by dreduce and dscan.
+    Operators must be associative and commutative, as partial results
+    are combined in the order the subtrees answer.
+    '''
+    operators[operator.__name__] = operator
+    return operator
+
+
+def register_function(function):
+    '''
+    Registers a function usable by dmap and dreduce,
+    called with an array value followed by the extra arguments.
+    '''
+    functions[function.__name__] = function
+    return function
+
+
+@register_operator
+def add(a, b):
+    return a + b
+
+
+@register_operator
+def multiply(a, b):
+    return a * b
+
+
+@register_operator
+def minimum(a, b):
+    return min(a, b)
+
+
+@register_operator
+def maximum(a, b):
+    return max(a, b)
+
+
+@register_function
+def bucket(value, width):
+    '''
+    Histogram bucket of a value, to be reduced with add.
+    '''
+    return Counter({value // width: 1})
+
+
+@register_function
+def scale(value, factor):
+    return value * factor
+
+
+def reduce_values(operator, values):
+    '''
+    Reduces the written values of a chunk, returns None if there is none.
+    '''
+    values = [value for value in values if value is not None]
+    if len(values) == 0:
+        return None
+    return reduce(operators[operator], values)
+
+
+def combine_partials(operator, a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return operators[operator](a, b)
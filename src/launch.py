@@ -14,6 +14,16 @@ parser.add_argument('--node_size', help="Number of variable an allocator can pos
 parser.add_argument('--nb_children', help="Number of children for each node", default=3, type=int)
 parser.add_argument('--quicksort', help="Launch a distributed quicksort implementation instead of unit tests",
                     default=False, action="store_true")
+parser.add_argument('--readahead', help="Number of array indices an application reads ahead on sequential scans",
+                    default=0, type=int)
+parser.add_argument('--stats_file', help="Periodically dump the cluster-wide allocator stats in this file",
+                    default=None)
+parser.add_argument('--stats_interval', help="Minimum number of seconds between two stats dumps",
+                    default=10, type=float)
+parser.add_argument('--window', help="Number of requests a process can send to a peer before getting credits back, "
+                                     "0 disables the flow control", default=16, type=int)
+parser.add_argument('--write_buffer', help="Number of array writes an application combines before sending them, "
+                                           "0 sends each write immediately", default=0, type=int)
 parser.add_argument('--verbose', action="store_true", help="Enable verbose mode", default=False)
 parser.add_argument('--log', action="store_true", help="Write logfiles", default=False)
 args = parser.parse_args()
@@ -36,15 +46,21 @@ def run_apps(apps):
     for application_ctor in apps:
         try:
             if rank < size // 2:
-                process = TreeAllocator(rank, nb_children, comm, node_size, size // 2, verbose=VERBOSE)
+                options = dict(size=node_size, stats_file=args.stats_file, stats_interval=args.stats_interval,
+                               window=args.window)
+                options.update(application_ctor.allocator_options)
+                process = TreeAllocator(rank, nb_children, comm, tree_size=size // 2, verbose=VERBOSE, **options)
             else:
                 allocator_rank = random.randint(0, size // 2 - 1)
-                process = application_ctor(rank, allocator_rank, comm, verbose=VERBOSE, app_com=partition_comm, log=LOG)
+                options = dict(readahead=args.readahead, window=args.window, write_buffer=args.write_buffer)
+                options.update(application_ctor.options)
+                process = application_ctor(rank, allocator_rank, comm, verbose=VERBOSE, app_com=partition_comm, log=LOG,
+                                           **options)
             comm.barrier()
             process.run()
 
             if rank >= size // 2:
-                partition_comm.barrier()
+                process.barrier()
 
             if rank == size // 2:
                 process.log('Call termination procedure on allocator')
@@ -1,9 +1,36 @@
+from collections import Counter
+
+from mpi4py import MPI
+
+
+class Retry:
+    '''
+    Response sent back instead of processing a request
+    when the allocator is saturated. The client should send it again later.
+    '''
+    def __init__(self, request):
+        self.request = request
+
+
+epoch = 0
+
+
 class MPI_process:  # TODO: Singleton
     '''
     Implements the send, receive and log function for all the
     kinds of MPI_process.
+    Requests (tag 1) use a credit-based flow control: a process can have at most
+    window requests not yet handled by each peer. Every message carries the number
+    of requests handled from its destination, and its window: credits are also sent
+    on tag 2 every half window of the sender, so both sides may use different windows.
+    Every rank creates its processes in the same order, and a message carries the
+    epoch of its sender: the credits still in flight when a process is replaced
+    are ignored by the next one.
     '''
-    def __init__(self, rank, comm, verbose, appname, clock=0, savelog=False):
+    def __init__(self, rank, comm, verbose, appname, clock=0, savelog=False, window=16):
+        global epoch
+        self.epoch = epoch
+        epoch += 1
         self.rank = rank
         self.verbose = verbose
         self.comm = comm
@@ -11,23 +38,55 @@ class MPI_process:  # TODO: Singleton
         self.savelog = savelog
         if self.savelog:
             self.logfile = open(f'process{self.rank}_{appname}.log', 'w')
+        self.window = window
+        self.sent = Counter()  # rank -> requests sent
+        self.acked = Counter()  # rank -> requests handled by the peer
+        self.consumed = Counter()  # rank -> requests handled from the peer
+        self.credited = Counter()  # rank -> last consumed count sent on tag 2
+        self.pending_sends = []
 
     # TODO: better src/dst handling using MPI status objects
 
     def _send(self, data, dest, tag):
-        data = {'clock': self.clock, 'data': data, 'src': self.rank, 'dst': dest}
-        self.comm.isend(data, dest=dest, tag=tag)
+        data = {'clock': self.clock, 'data': data, 'src': self.rank, 'dst': dest,
+                'epoch': self.epoch, 'ack': self.consumed[dest], 'window': self.window}
+        self.pending_sends.append(self.comm.isend(data, dest=dest, tag=tag))
+        self.pending_sends = [request for request in self.pending_sends if not request.Test()]
+        if tag == 1:
+            self.sent[dest] += 1
         self.clock += 1
         self.log(f"send: {data} on tag {tag}")
 
-    def _receive(self, src, tag):
-        data = self.comm.recv(source=src, tag=tag)
+    def _receive(self, src, tag, status=None):
+        data = self.comm.recv(source=src, tag=tag, status=status)
         self.log('waiting for {}'.format(src))
         self.log('done waiting for {}'.format(src))
         self.clock = max(self.clock, data['clock']) + 1
+        if data['epoch'] == self.epoch:
+            self.acked[data['src']] = max(self.acked[data['src']], data['ack'])
         self.log(f'received: {data} on tag {tag}')
         return data
 
+    def _has_credit(self, dest):
+        return not self.window or self.sent[dest] - self.acked[dest] < self.window
+
+    def _consume(self, message):
+        '''
+        Marks a request as handled, and gives credits back to its sender
+        every half window of the sender.
+        '''
+        src = message['src']
+        window = message['window']
+        self.consumed[src] += 1
+        if window and self.consumed[src] - self.credited[src] >= max(window // 2, 1):
+            self.credited[src] = self.consumed[src]
+            self._send(None, src, 2)
+
+    def _receive_credits(self, src=MPI.ANY_SOURCE):
+        status = MPI.Status()
+        while self.comm.Iprobe(source=src, tag=2, status=status):
+            self._receive(status.Get_source(), 2)
+
     def log(self, msg, highlight=False):
         msg = 'N{} [clk|{}]: {}'.format(self.rank, self.clock, msg)
         if highlight:
@@ -42,6 +42,7 @@ class QuickSort(Application):
                 before_sort = arr
                 self.quicksort(vid, size)
                 after_sort = []
+                self.prefetch(vid, 0, arr_len)
                 for i in range(arr_len):
                     after_sort.append(self.read(vid, index=i))
                 print(f'--- size={size}\nBefore_sort = {before_sort}')
@@ -29,12 +29,15 @@ class Variable(Storage):
 
 
 class Array(Variable):
-    def __init__(self, request_process, rank, size, next):
+    def __init__(self, request_process, rank, size, next, array=None, offset=0):
         super().__init__(request_process, rank)
         self.size = size
         self.value = [None] * self.size
         self.next = next
+        # id of the first allocated chunk, shared by all the chunks of the array
+        self.array = self.id if array is None else array
+        self.offset = offset
 
     def __repr__(self):
         r = super().__repr__()
-        return f'{r}, size={self.size}, next={self.next}'
+        return f'{r}, size={self.size}, next={self.next}, offset={self.offset}'
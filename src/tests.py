@@ -1,4 +1,5 @@
 from application import Application
+from mpi_process import Retry
 from storage import Variable, Array
 
 
@@ -162,3 +163,287 @@ class ArrayFree(BigArrayAlloc):
         vid = super().run()
         if vid is not None:
             self.free(vid)
+
+
+@register_app
+class ChunkedArray(Application):
+    allocator_options = {'size': 1}  # one chunk of the array on each allocator
+
+    def run(self):
+        if self.app_com.Get_rank() == 0:
+            vid = self.allocate(size=4)
+            if vid is None:
+                self.log('Not enough memory!')
+                return
+            for i in range(4):
+                self.write(vid, 4 - i, i)
+            tab = [self.read(vid, index=i) for i in range(4)]
+            self.prefetch(vid, 0, 4)
+            tab_prefetched = [self.read(vid, index=i) for i in range(4)]
+            self.log(f'Chunked array: {tab}, prefetched: {tab_prefetched}', True)
+            if tab != [4, 3, 2, 1] or tab_prefetched != tab:
+                raise RuntimeError(f'Invalid chunked array on app {self.rank} with vid {vid}: {tab}, {tab_prefetched}')
+            self.free(vid)
+
+
+@register_app
+class ArrayScan(Application):
+    options = {'readahead': 4}
+    allocator_options = {'size': 5}  # the array spans every allocator
+
+    def run(self):
+        if self.app_com.Get_rank() == 0:
+            size = 20
+            vid = self.allocate(size=size)
+            if vid is None:
+                self.log('Not enough memory!')
+                return
+            for i in range(size):
+                self.write(vid, i * i, i)
+            scans = {
+                'forward': range(size),
+                'backward': reversed(range(size)),
+                'strided': range(0, size, 3),
+                'backward strided': range(size - 1, -1, -3),
+            }
+            for name, indices in scans.items():
+                indices = list(indices)
+                self._drop_prefetched(vid)
+                sent = self.sent[self.allocator_rank]
+                tab = [self.read(vid, index=i) for i in indices]
+                nb_requests = self.sent[self.allocator_rank] - sent
+                self.log(f'{name} scan: {tab} in {nb_requests} requests', True)
+                if tab != [i * i for i in indices]:
+                    raise RuntimeError(f'Invalid {name} scan on app {self.rank} with vid {vid}: {tab}')
+                if nb_requests > size // 2:
+                    raise RuntimeError(f'No read-ahead on the {name} scan of app {self.rank}: {nb_requests} requests')
+                unread = [key[1] for key in self.prefetched if key[0] == vid and key[1] not in indices]
+                if unread:
+                    raise RuntimeError(f'Read ahead outside of the {name} scan of app {self.rank}: {unread}')
+            sent = self.sent[self.allocator_rank]
+            self.prefetch(vid, 0, size)
+            tab = [self.read(vid, index=i) for i in range(size)]
+            nb_requests = self.sent[self.allocator_rank] - sent
+            self.log(f'prefetched scan: {tab} in {nb_requests} requests', True)
+            if tab != [i * i for i in range(size)] or nb_requests > size // 2:
+                raise RuntimeError(f'Invalid prefetched scan on app {self.rank} with vid {vid}: {tab}')
+
+
+@register_app
+class BufferedReadAhead(Application):
+    options = {'readahead': 4, 'write_buffer': 8}
+
+    def run(self):
+        if self.app_com.Get_rank() == 0:
+            size = 8
+            vid = self.allocate(size=size)
+            if vid is None:
+                self.log('Not enough memory!')
+                return
+            for i in range(size):
+                self.write(vid, 0, i)
+            self.flush()
+            self.write(vid, 99, 3)
+            # the read-ahead of this scan covers the buffered index
+            tab = [self.read(vid, index=i) for i in range(3)]
+            self.flush()
+            value = self.read(vid, index=3)
+            self.log(f'Buffered write read back after read-ahead: {value}', True)
+            if tab != [0, 0, 0] or value != 99:
+                raise RuntimeError(f'Stale read on app {self.rank} with vid {vid}: {tab}, {value}')
+
+
+@register_app
+class ConcurrentBufferedWrite(Application):
+    options = {'write_buffer': 8}
+
+    def run(self):
+        vid = None
+        if self.app_com.Get_rank() == 0:
+            vid = self.allocate(size=2)
+        vid = self.app_com.bcast(vid, root=0)
+        if vid is None:
+            return
+        if self.app_com.Get_rank() == 0:
+            self.write(vid, 'A', 0)
+        self.app_com.barrier()
+        if self.app_com.Get_rank() == 1:
+            for _ in range(10):  # the clock of B gets ahead of the one of A
+                self.read(vid, index=1)
+            self.write(vid, 'B', 1)
+            self.flush()
+        self.app_com.barrier()
+        if self.app_com.Get_rank() == 0:
+            # the buffered write happens after the write of B it has seen
+            seen = self.read(vid, index=1)
+            applied = self.flush()
+            tab = [self.read(vid, index=i) for i in range(2)]
+            self.log(f'Concurrent buffered writes: saw {seen}, applied {applied}, read back {tab}', True)
+            if seen != 'B' or applied != 1 or tab != ['A', 'B']:
+                raise RuntimeError(f'Lost buffered write on app {self.rank} with vid {vid}: {seen}, {applied}, {tab}')
+
+
+@register_app
+class ClusterStats(Application):
+    def run(self):
+        vid = self.allocate()
+        self.app_com.barrier()
+        if self.app_com.Get_rank() == 0:
+            stats = self.stats()
+            self.log(f'Cluster stats: {stats["total"]}', True)
+            if len(stats['nodes']) != self.comm.Get_size() // 2:  # the first half of the ranks are allocators
+                raise RuntimeError(f'Invalid stats on app {self.rank}, missing allocators: {stats["nodes"].keys()}')
+            if vid is not None and stats['total']['variables'] < 1:
+                raise RuntimeError(f'Invalid stats on app {self.rank}, variable {vid} not counted')
+
+
+@register_app
+class ArrayCollectives(BigArrayAlloc):
+    def run(self):
+        if self.app_com.Get_rank() == 0:
+            vid = super().run()
+            if vid is None:
+                return
+            values = [3, 1, 4, 1, 5]
+            for i, value in enumerate(values):
+                self.write(vid, value, i)
+            clock = self.clock  # after the writes, before the collective operations
+            results = {
+                'sum': self.dreduce(vid, 'add'),
+                'max': self.dreduce(vid, 'maximum'),
+                'histogram': self.histogram(vid, 2),
+                'mapped': self.dmap(vid, 'scale', (2,)),
+                'scan': self.dscan(vid, 'add'),
+                # a write older than the collective operations is not applied
+                'stale_write': self._request({'handler': 'dwrite_batch', 'vid': vid, 'writes': [(0, -1, clock)]}),
+                'array': [self.read(vid, index=i) for i in range(6)],
+            }
+            self.log(f'Collective results: {results}', True)
+            expected = {
+                'sum': 14,
+                'max': 5,
+                'histogram': {1: 1, 0: 2, 2: 2},
+                'mapped': 5,
+                'scan': 28,
+                'stale_write': 0,
+                'array': [6, 8, 16, 18, 28, None],
+            }
+            if results != expected:
+                raise RuntimeError(f'Invalid collective operations on app {self.rank} with vid {vid}: {results}')
+
+
+@register_app
+class ChunkedArrayCollectives(ArrayCollectives):
+    allocator_options = {'size': 2}  # the chunks are combined across subtrees
+
+
+@register_app
+class RequestFlood(Application):
+    # a small window, so that the flood outruns the allocator without flow control
+    options = {'window': 4}
+    allocator_options = {'window': 4}
+
+    def run(self):
+        vid = self.allocate(size=4)
+        if vid is None:
+            return
+        for i in range(4):
+            self.write(vid, i, i)
+        self.flush()
+        nb_requests = 20 * max(self.window, 1)
+        in_flight = 0  # requests not yet handled by the allocator
+        for i in range(nb_requests):
+            self._send({
+                    'handler': 'read_chunk',
+                    'vid': vid,
+                    'index': i % 4,
+                    'stop': i % 4 + 1,
+                    'key': (vid, i),
+                    'response_tag': 11,
+                }, self.allocator_rank, 1)
+            in_flight = max(in_flight, self.sent[self.allocator_rank] - self.acked[self.allocator_rank])
+        replies = [self._receive(self.allocator_rank, 11)['data'] for _ in range(nb_requests)]
+        served = [reply for reply in replies if type(reply) != Retry]
+        self.log(f'Flood of {nb_requests} requests, {nb_requests - len(served)} retries, '
+                 f'at most {in_flight} in flight', True)
+        for reply in served:
+            if reply['values'] != [reply['key'][1] % 4]:
+                raise RuntimeError(f'Invalid read on app {self.rank} with vid {vid}: {reply}')
+        if self.window and in_flight > self.window:
+            raise RuntimeError(f'No backpressure on app {self.rank}: {in_flight} requests in flight')
+        queue_depth = self.stats()['nodes'][self.allocator_rank]['max_queue_depth']
+        # every other process can fill a window of the allocator queue
+        if self.window and queue_depth > self.window * (self.comm.Get_size() - 1):
+            raise RuntimeError(f'Unbounded queue on allocator {self.allocator_rank}: {queue_depth} requests')
+
+
+@register_app
+class MismatchedWindows(Application):
+    options = {'window': 2}  # credits are sent every half window of the application
+
+    def run(self):
+        size = 4
+        vid = self.allocate(size=size)
+        if vid is None:
+            return
+        for i in range(size):
+            self.write(vid, i, i)
+        for step in range(3):
+            for i in range(size):
+                self.prefetch(vid, i, i + 1)
+            tab = [self.read(vid, index=i) for i in range(size)]
+            if tab != list(range(size)):
+                raise RuntimeError(f'Invalid reads on app {self.rank} with vid {vid}: {tab}')
+            if self.sent[self.allocator_rank] - self.acked[self.allocator_rank] > self.window:
+                raise RuntimeError(f'No backpressure on app {self.rank}: window of {self.window} exceeded')
+
+
+@register_app
+class UnboundedAllocators(MismatchedWindows):
+    allocator_options = {'window': 0}
+
+
+@register_app
+class BufferedWrite(BigArrayAlloc):
+    def run(self):
+        if self.app_com.Get_rank() == 0:
+            vid = super().run()
+            if vid is None:
+                return
+            self.write_buffer = 8
+            for i in range(6):
+                self.write(vid, i, i)
+            for i in range(6):
+                self.write(vid, 10 * i, i)
+            buffered = [self.read(vid, index=i) for i in range(6)]
+            applied = self.flush()
+            tab = [self.read(vid, index=i) for i in range(6)]
+            self.log(f'Buffered: {buffered}, applied {applied} writes, read back: {tab}', True)
+            expected = [10 * i for i in range(6)]
+            if buffered != expected or tab != expected:
+                raise RuntimeError(f'Invalid buffered writes on app {self.rank} with vid {vid}: {buffered}, {tab}')
+
+
+@register_app
+class SaturatedAllocator(Application):
+    options = {'window': 64, 'write_buffer': 4}
+    allocator_options = {'size': 10, 'window': 1, 'saturation': 2}
+
+    def run(self):
+        self.allocator_rank = 0  # every application floods the root
+        size = 8
+        vid = self.allocate(size=size)
+        if vid is not None:
+            for step in range(5):
+                for i in range(size):
+                    self.prefetch(vid, i, i + 1)
+                for i in range(size):
+                    self.write(vid, 10 * step + i, i)
+                tab = [self.read(vid, index=i) for i in range(size)]
+                if tab != [10 * step + i for i in range(size)]:
+                    raise RuntimeError(f'Invalid reads on saturated allocator, app {self.rank} with vid {vid}: {tab}')
+            self.flush()
+        nb_retries = self.app_com.allreduce(self.retries)
+        self.log(f'Saturated allocator: {self.retries} retries, {nb_retries} for every application', True)
+        if nb_retries == 0:
+            raise RuntimeError(f'The allocator never got saturated, app {self.rank}')
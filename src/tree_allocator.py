@@ -1,14 +1,90 @@
+from collections import Counter
+import json
+import time
+
 from allocator import Allocator, register_handler, public_handler
+from collectives import operators, functions, reduce_values, combine_partials
 from storage import Variable, Array
 
 
+gather_operations = {}
+
+
+def register_gather(combine, finish=None, then=None):
+    '''
+    Registers the local part of a tree gather.
+    Partial results are merged with combine on the way up the tree,
+    and finish builds the final result on the root.
+    If then is set, the final result is given as gather_input
+    to a new gather operation instead of being sent back.
+    '''
+    def decorator(local):
+        gather_operations[local.__name__] = (local, combine, finish, then)
+        return local
+
+    return decorator
+
+
+def _merge_snapshots(data, a, b):
+    return {**a, **b}
+
+
+def _combine_partials(data, a, b):
+    return combine_partials(data['operator'], a, b)
+
+
+def _add_counts(data, a, b):
+    return a + b
+
+
+def _scan_carries(data, totals):
+    '''
+    Computes the value carried into each chunk of a scan,
+    from the total of every chunk ordered by offset.
+    '''
+    carries = {}
+    carry = None
+    for offset in sorted(totals):
+        carries[offset] = carry
+        carry = combine_partials(data['operator'], carry, totals[offset])
+    return carries
+
+
+def _scan_total(data, lasts):
+    if len(lasts) == 0:
+        return None
+    return lasts[max(lasts)]
+
+
+def _total_snapshot(data, nodes):
+    '''
+    Builds the cluster-wide stats from the stats of each allocator.
+    '''
+    received = Counter()
+    forwarded = Counter()
+    for node in nodes.values():
+        received.update(node['received'])
+        forwarded.update(node['forwarded'])
+    total = {
+        'variables': sum(node['variables'] for node in nodes.values()),
+        'local_size': sum(node['local_size'] for node in nodes.values()),
+        'received': dict(received),
+        'forwarded': dict(forwarded),
+        'bytes_received': sum(node['bytes_received'] for node in nodes.values()),
+        'max_queue_depth': max(node['max_queue_depth'] for node in nodes.values()),
+        'busiest': sorted(nodes, key=lambda rank: sum(nodes[rank]['received'].values()), reverse=True)[:3],
+    }
+    return {'nodes': nodes, 'total': total}
+
+
 class TreeAllocator(Allocator):
     '''
     This class defines our Tree and implements the usefull functions
     It inherits from the allocator class, and builds a list of children based on the nb_children
     '''
-    def __init__(self, rank, nb_children, comm, size, tree_size, verbose=False):
-        super(TreeAllocator, self).__init__(rank, comm, size, verbose)
+    def __init__(self, rank, nb_children, comm, size, tree_size, verbose=False, stats_file=None, stats_interval=10,
+                 window=16, saturation=None):
+        super(TreeAllocator, self).__init__(rank, comm, size, verbose, window, saturation)
         self.tree_size = tree_size
         self.nb_children = nb_children
         # use a tree topology
@@ -16,6 +92,12 @@ class TreeAllocator(Allocator):
         self.parent = None
         if rank:
             self.parent = (rank - 1) // nb_children
+        self.gathers = {}
+        self.gather_count = 0
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.last_stats_dump = time.time()
+        self.stop_requested = False
 
     def response_handler(self, metadata, return_value_id='response'):
         '''
@@ -26,7 +108,7 @@ class TreeAllocator(Allocator):
         master = data['master']
         caller = data['caller']
         if self.rank == master:
-            self._send(data[return_value_id], caller, 10)
+            self._send(data[return_value_id], caller, data.get('response_tag', 10))
             return
         if master in self.children:
             self._send(data, master, 1)
@@ -110,6 +192,49 @@ class TreeAllocator(Allocator):
         '''
         self.search_tree(metadata, self.dwrite_response_handler)
 
+    @register_handler
+    def dwrite_batch_response_handler(self, metadata):
+        '''
+        handler for the dwrite_batch function
+        Applies the writes of the local array in the order of their clocks,
+        each one only if its clock is greater than the last_write_clock,
+        and forwards the writes with a greater index to the next array.
+        Sends back the number of writes applied.
+        '''
+        data = metadata['data']
+        if 'written' not in data:
+            var = self.variables[data['vid']]
+            applied = data.get('applied', 0)
+            writes = sorted(data['writes'], key=lambda write: write[2])
+            remaining = []
+            for index, value, clock in writes:
+                if type(var) == Array and index >= var.size:
+                    remaining.append((index - var.size, value, clock))
+                elif var.last_write_clock < clock:
+                    if type(var) == Variable:
+                        var.value = value
+                    else:
+                        var.value[index] = value
+                    var.last_write_clock = clock
+                    applied += 1
+            if len(remaining) != 0 and type(var) == Array and var.next is not None:
+                data['writes'] = remaining
+                data['applied'] = applied
+                data['vid'] = var.next
+                self.dwrite_batch(metadata)
+                return
+            data['written'] = applied
+        self.response_handler(metadata, 'written')
+
+    @register_handler
+    @public_handler
+    def dwrite_batch(self, metadata):
+        '''
+        Writes a batch of (index, value, clock) to a variable in a single request.
+        The clocks are the ones of the applications when the values were written.
+        '''
+        self.search_tree(metadata, self.dwrite_batch_response_handler)
+
     @register_handler
     def _stop_handler(self, metadata):
         self.stop = True
@@ -125,9 +250,239 @@ class TreeAllocator(Allocator):
             if 'message' in data:
                 new_data['message'] = data['message']
             self._send(new_data, self.parent, 1)
+        elif len(self.gathers) != 0:  # stop once the pending gathers are done
+            self.stop_requested = True
         else:
             self._stop_handler(None)
 
+    @register_handler
+    @public_handler
+    def stats(self, metadata):
+        '''
+        Cluster-wide stats. The request goes up to the root,
+        which gathers the counters of every allocator.
+        '''
+        self.tree_gather(metadata, 'stats_snapshot')
+
+    @register_handler
+    @public_handler
+    def dreduce(self, metadata):
+        '''
+        Distributed reduce of an array with a registered operator,
+        optionally applying a registered function to the values first.
+        Each allocator reduces its own chunks, and partial results
+        are combined up the tree. Unwritten values are skipped.
+        '''
+        metadata['data']['gather'] = 'reduce_chunks'
+        self.search_tree(metadata, self.collective_response_handler)
+
+    @register_handler
+    @public_handler
+    def dscan(self, metadata):
+        '''
+        Distributed inclusive prefix scan of an array, in place.
+        A first gather collects the total of each chunk, the root computes
+        the value carried into each chunk, and a second gather applies the scan.
+        Sends back the total of the array.
+        '''
+        metadata['data'].setdefault('clock', metadata['clock'])
+        metadata['data']['gather'] = 'scan_totals'
+        self.search_tree(metadata, self.collective_response_handler)
+
+    @register_handler
+    @public_handler
+    def dmap(self, metadata):
+        '''
+        Distributed map of a registered function on an array, in place.
+        Sends back the number of values updated.
+        '''
+        metadata['data'].setdefault('clock', metadata['clock'])
+        metadata['data']['gather'] = 'map_chunks'
+        self.search_tree(metadata, self.collective_response_handler)
+
+    @register_handler
+    def collective_response_handler(self, metadata):
+        '''
+        handler for the collective operations, called on the owner of the vid.
+        Tags the request with the array the vid belongs to,
+        and starts the gather operation from the root.
+        '''
+        data = metadata['data']
+        var = self.variables[data['vid']]
+        if type(var) != Array:
+            data['handler'] = '_gather_result_handler'
+            data['gather_result'] = None
+            self._gather_result_handler(metadata)
+            return
+        data['array'] = var.array
+        self.tree_gather(metadata, data['gather'])
+
+    def _array_chunks(self, array):
+        return [var for var in self.variables.values() if type(var) == Array and var.array == array]
+
+    @register_gather(combine=_combine_partials)
+    def reduce_chunks(self, data):
+        '''
+        Local part of dreduce.
+        '''
+        partial = None
+        for chunk in self._array_chunks(data['array']):
+            values = chunk.value
+            if data.get('function') is not None:
+                function = functions[data['function']]
+                values = [function(value, *data['args']) for value in values if value is not None]
+            partial = combine_partials(data['operator'], partial, reduce_values(data['operator'], values))
+        return partial
+
+    @register_gather(combine=_merge_snapshots, finish=_scan_carries, then='scan_chunks')
+    def scan_totals(self, data):
+        '''
+        First step of dscan, total of each local chunk by offset.
+        '''
+        return {chunk.offset: reduce_values(data['operator'], chunk.value)
+                for chunk in self._array_chunks(data['array'])}
+
+    @register_gather(combine=_merge_snapshots, finish=_scan_total)
+    def scan_chunks(self, data):
+        '''
+        Second step of dscan, applies the scan on the local chunks
+        starting from the value carried into each of them.
+        Returns the last scanned value of each chunk by offset.
+        The chunks are written with the clock of the dscan request.
+        '''
+        operator = operators[data['operator']]
+        lasts = {}
+        for chunk in self._array_chunks(data['array']):
+            acc = data['gather_input'][chunk.offset]
+            for i, value in enumerate(chunk.value):
+                if value is None:
+                    continue
+                acc = value if acc is None else operator(acc, value)
+                chunk.value[i] = acc
+            chunk.last_write_clock = max(chunk.last_write_clock, data['clock'])
+            lasts[chunk.offset] = acc
+        return lasts
+
+    @register_gather(combine=_add_counts)
+    def map_chunks(self, data):
+        '''
+        Local part of dmap, the chunks are written with the clock of the dmap request.
+        '''
+        function = functions[data['function']]
+        count = 0
+        for chunk in self._array_chunks(data['array']):
+            for i, value in enumerate(chunk.value):
+                if value is not None:
+                    chunk.value[i] = function(value, *data['args'])
+                    count += 1
+            chunk.last_write_clock = max(chunk.last_write_clock, data['clock'])
+        return count
+
+    @register_gather(combine=_merge_snapshots, finish=_total_snapshot)
+    def stats_snapshot(self, data):
+        '''
+        Local part of the stats gather.
+        '''
+        return {self.rank: {
+            'variables': len(self.variables),
+            'local_size': self.local_size,
+            'received': dict(self.received),
+            'forwarded': dict(self.forwarded),
+            'bytes_received': self.bytes_received,
+            'max_queue_depth': self.max_queue_depth,
+            'busiest_peers': self.peers.most_common(3),
+        }}
+
+    def periodic(self):
+        '''
+        Dumps the cluster-wide stats in the stats file from the root,
+        checked between two requests.
+        '''
+        if self.parent is not None or self.stats_file is None or self.stop_requested:
+            return
+        if time.time() - self.last_stats_dump < self.stats_interval:
+            return
+        if any('master' not in gather['data'] for gather in self.gathers.values()):
+            return
+        self.last_stats_dump = time.time()
+        self.tree_gather({'data': {'handler': 'stats'}}, 'stats_snapshot')
+
+    def tree_gather(self, metadata, operation):
+        '''
+        Sends the request up to the root, which broadcasts it down the tree.
+        Every allocator computes its local part of the gather operation,
+        and the results are combined on the way back up.
+        '''
+        data = metadata['data']
+        data['gather'] = operation
+        if self.parent is not None:
+            data['handler'] = '_gather_request_handler'
+            self._send(data, self.parent, 1)
+            return
+        data['gather_id'] = (self.rank, self.gather_count)
+        self.gather_count += 1
+        self._gather_handler({'data': data})
+
+    @register_handler
+    def _gather_request_handler(self, metadata):
+        self.tree_gather(metadata, metadata['data']['gather'])
+
+    @register_handler
+    def _gather_handler(self, metadata):
+        data = metadata['data']
+        local = gather_operations[data['gather']][0]
+        result = local(self, data)
+        if len(self.children) == 0:
+            self._gather_reply(data, result)
+            return
+        self.gathers[data['gather_id']] = {'remaining': len(self.children), 'result': result, 'data': data}
+        for child in self.children:
+            self._send(dict(data, handler='_gather_handler'), child, 1)
+
+    @register_handler
+    def _gather_response_handler(self, metadata):
+        data = metadata['data']
+        gather = self.gathers[data['gather_id']]
+        combine = gather_operations[gather['data']['gather']][1]
+        gather['result'] = combine(gather['data'], gather['result'], data['result'])
+        gather['remaining'] -= 1
+        if gather['remaining'] == 0:
+            del self.gathers[data['gather_id']]
+            self._gather_reply(gather['data'], gather['result'])
+
+    def _gather_reply(self, data, result):
+        '''
+        Sends a partial result to the parent,
+        or the final result back to the caller once on the root.
+        '''
+        if self.parent is not None:
+            self._send({
+                    'handler': '_gather_response_handler',
+                    'gather_id': data['gather_id'],
+                    'result': result,
+                }, self.parent, 1)
+            return
+        finish, then = gather_operations[data['gather']][2:]
+        if finish is not None:
+            result = finish(data, result)
+        if then is not None:
+            data['gather_input'] = result
+            self.tree_gather({'data': data}, then)
+            return
+        if self.stop_requested and len(self.gathers) == 0:
+            self._stop_handler(None)
+        if 'master' not in data:  # periodic stats dump
+            with open(self.stats_file, 'a') as f:
+                f.write(json.dumps({'time': time.time(), 'stats': result}) + '\n')
+            return
+        data['handler'] = '_gather_result_handler'
+        data['gather_result'] = result
+        self._gather_result_handler({'data': data})
+
+    @register_handler
+    def _gather_result_handler(self, metadata):
+        self.response_handler(metadata, 'gather_result')
+
     @register_handler
     def dmalloc_response_handler(self, metadata):
         data = metadata['data']
@@ -159,13 +514,14 @@ class TreeAllocator(Allocator):
 
         if 'prev' in data:
             next = data['prev']
-        if 'size' not in data or data['size'] == 1:
+        if ('size' not in data or data['size'] == 1) and next is None:
             ctor = Variable
             size = 1
         else:
             size = data['size']
             arr_size = min(size, self.local_size)
-            ctor = lambda req, rank: Array(req, rank, arr_size, next)
+            # the chunks are linked from the last one allocated
+            ctor = lambda req, rank: Array(req, rank, arr_size, next, data.get('array'), size - arr_size)
 
         local_alloc_size = min(size, self.local_size)
         child_alloc_size = size - local_alloc_size
@@ -174,6 +530,8 @@ class TreeAllocator(Allocator):
             self.local_size -= local_alloc_size
             var = ctor(data['caller'], self.rank)
             data['prev'] = var.id
+            if type(var) == Array:
+                data['array'] = var.array
             self.variables[var.id] = var
             data['vid'] = var.id
             if child_alloc_size == 0:
@@ -231,6 +589,42 @@ class TreeAllocator(Allocator):
         '''
         self.search_tree(metadata, self.read_response_handler)
 
+    @register_handler
+    def read_chunk_response_handler(self, metadata):
+        '''
+        handler for the read_chunk function
+        Collect the values of the local part of the requested range,
+        every step indices, and follow the linked list of arrays for the remaining indices.
+        '''
+        data = metadata['data']
+        if 'chunk' not in data:
+            tab = self.variables[data['vid']]
+            if type(tab) == Variable:
+                data['values'] = [tab.value]
+            else:
+                index = data['index']
+                stop = data['stop']
+                step = data.get('step', 1)
+                data['values'] = data.get('values', []) + tab.value[index:min(stop, tab.size):step]
+                if stop > tab.size and tab.next is not None:
+                    # first index of the range in the next array
+                    data['index'] = index - tab.size if index >= tab.size else (index - tab.size) % step
+                    data['stop'] -= tab.size
+                    data['vid'] = tab.next
+                    self.read_chunk(metadata)
+                    return
+            data['chunk'] = {'key': data['key'], 'values': data['values']}
+        self.response_handler(metadata, 'chunk')
+
+    @register_handler
+    @public_handler
+    def read_chunk(self, metadata):
+        '''
+        Read a range of indices of an array in a single request.
+        Used by the applications to prefetch array values.
+        '''
+        self.search_tree(metadata, self.read_chunk_response_handler)
+
     def search_tree(self, metadata, response_handler):
         '''
         Finds the owner of a vid in our tree.
@@ -268,10 +662,12 @@ class TreeAllocator(Allocator):
         self._send(data, self.parent, 1)
 
 
-def _is_ancestor(a, n, k, tree_size, l=list()):
+def _is_ancestor(a, n, k, tree_size, l=None):
     '''
     Finds the path from the local process to an other process.
     '''
+    if l is None:
+        l = []
     if n >= tree_size:
         return False, l
     if n == 0: